@@ -0,0 +1,413 @@
+"""NumPy/Numba building blocks shared by the scripts that process songs."""
+
+import errno
+import io
+import logging
+import os
+import re
+import subprocess
+import threading
+from enum import Enum
+from functools import lru_cache
+from typing import NoReturn, Optional
+
+import numpy as np
+import pyloudnorm as pyln
+from numba import njit, prange
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import mediainfo_json
+
+
+_logger = logging.getLogger(__name__)
+
+_SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+_CHUNK_MS = 10
+
+_NORMALIZE_HEADROOM = 0.1
+
+_READ_BUFFER_SIZE = 1 << 20
+
+# below this many samples, the NumPy path is faster than dispatching to the Numba kernel
+_NUMBA_MIN_SAMPLES = 1 << 18
+
+_FFMPEG_SAMPLE_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
+
+_scratch = threading.local()
+
+# 128 MiB of float32, a little over 6 minutes of 44.1 kHz stereo
+_SCRATCH_MAX_SIZE = 1 << 25
+
+# ffmpeg prints these with '%.6g', so tiny values come out in exponent notation
+_SILENCEDETECT_RE = re.compile(rb"silence_(start|end):\s*(-?[\d.]+(?:e[-+]?\d+)?)")
+
+
+
+class SilenceDetector(str, Enum):
+    """How 'trim_silence' finds the silence at either end of the audio."""
+
+    CHUNK  = "chunk"
+    FFMPEG = "ffmpeg"
+
+
+
+def arg_error(message: str) -> NoReturn:
+    """Logs 'message' as critical and raises it as a ValueError."""
+    _logger.critical(message)
+    raise ValueError(message)
+
+
+@lru_cache(maxsize=8)
+def _meter(rate: int) -> pyln.Meter:
+    """BS.1770 meter for 'rate', so that its filters are only designed once per sample rate."""
+    return pyln.Meter(rate)
+
+
+
+def load_pcm(input_audio) -> tuple[np.ndarray, int]:
+    """
+    (frames, channels) PCM and sample rate of 'input_audio'.
+    Files are probed for their layout, then decoded to PCM piped straight out of ffmpeg,
+    16-bit for sources of at most that depth and 32-bit otherwise; streams still go through pydub.
+    """
+
+    if isinstance(input_audio, io.IOBase):
+        song = AudioSegment.from_file(input_audio)
+        return (np.frombuffer(song.raw_data, dtype=_SAMPLE_DTYPES[song.sample_width]).reshape(-1, song.channels),
+                song.frame_rate)
+
+    if not os.path.exists(input_audio):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(input_audio))
+
+    audio_streams = [stream for stream in mediainfo_json(str(input_audio)).get("streams", [])
+                     if stream.get("codec_type") == "audio"]
+
+    if not audio_streams:
+        raise CouldntDecodeError(f"No audio stream found in '{input_audio}'")
+
+    stream = audio_streams[0]
+
+    # deeper (or float) sources are not quantized to 16 bits before being boosted by the gains applied later
+    if stream.get("sample_fmt", "").startswith(("u8", "s16")):
+        sample_format, dtype = "s16le", np.int16
+    else:
+        sample_format, dtype = "s32le", np.int32
+
+    decoder = subprocess.Popen(
+                               [
+                                "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+                                "-i"  , str(input_audio),
+                                "-map", "0:a:0",
+                                "-ac" , str(stream["channels"]),
+                                "-ar" , str(stream["sample_rate"]),
+                                "-f"  , sample_format, "-",
+                               ],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               bufsize=_READ_BUFFER_SIZE,
+                              )
+
+    pcm, stderr = decoder.communicate()
+
+    if decoder.returncode != 0:
+        raise CouldntDecodeError(f"Decoding '{input_audio}' failed: {stderr.decode(errors='replace')}")
+
+    return (np.frombuffer(pcm, dtype=dtype).reshape(-1, int(stream["channels"])),
+            int(stream["sample_rate"]))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _square_sums_kernel(chunks: np.ndarray, out: np.ndarray) -> None:
+    """
+    Sum of squares of each row of 'chunks' added into 'out', in the dtype of 'out',
+    with the rows spread across CPU cores.
+    """
+
+    for i in prange(out.size):
+        s = out[i]
+        for j in range(chunks.shape[1]):
+            v = chunks[i, j]
+            s += v * v
+        out[i] = s
+
+
+def _chunk_square_sums(samples: np.ndarray, chunk_frames: int, from_end: bool = False) -> np.ndarray:
+    """
+    Sum of squares of every whole 'chunk_frames' chunk of the (frames, channels) integer PCM 'samples',
+    computed in one vectorized pass without converting the samples to float.
+    Chunks are aligned to (and ordered from) the end of 'samples' if 'from_end' is set.
+    """
+
+    usable = len(samples) - len(samples) % chunk_frames
+    chunks = samples[len(samples) - usable:] if from_end else samples[:usable]
+    chunks = chunks.reshape(-1, chunk_frames * samples.shape[1])
+    if from_end:
+        chunks = chunks[::-1]
+
+    # int64 cannot overflow for 8 and 16-bit samples, but could for 32-bit ones
+    sum_dtype = np.int64 if samples.itemsize <= 2 else np.float64
+
+    if chunks.size > _NUMBA_MIN_SAMPLES:
+        square_sums = np.zeros(len(chunks), dtype=sum_dtype)
+        _square_sums_kernel(chunks, square_sums)
+    else:
+        square_sums = np.einsum("ij,ij->i", chunks, chunks, dtype=sum_dtype)
+
+    return square_sums
+
+
+def silent_end_ind(
+                   samples           : np.ndarray,
+                   rate              : int,
+                   silence_threshold : int | float,
+                   chunk_size        : int = _CHUNK_MS,
+                  ) -> int:
+    """
+    Index (in frames) where the silence at the start of the (frames, channels) PCM 'samples' ends,
+    or where the silence at its end starts if 'chunk_size' (in ms) is negative.
+    """
+
+    if not (isinstance(chunk_size, int) and chunk_size != 0):
+        arg_error("'chunk_size' must be a non-zero integer")
+
+    chunk_frames = max(abs(chunk_size) * rate // 1000, 1)
+
+    # the threshold is brought into the square-sum domain once, instead of every chunk into dBFS
+    max_amplitude = 1 << (8 * samples.itemsize - 1)
+    threshold_square_sum = (max_amplitude * 10 ** (silence_threshold / 20)) ** 2 * chunk_frames * samples.shape[1]
+
+    loud = _chunk_square_sums(samples, chunk_frames, from_end=chunk_size < 0) >= threshold_square_sum
+
+    silence_len = int(loud.argmax()) * chunk_frames if loud.any() else len(samples)
+
+    return silence_len if chunk_size > 0 else len(samples) - silence_len
+
+
+def ffmpeg_silence_bounds(
+                          samples           : np.ndarray,
+                          rate              : int,
+                          silence_threshold : int | float,
+                          min_silence_len   : int,
+                         ) -> tuple[int, int]:
+    """
+    Indices (in frames) where the leading silence of the (frames, channels) PCM 'samples' ends
+    and its trailing silence starts, as detected by ffmpeg's 'silencedetect' filter.
+    """
+
+    result = subprocess.run(
+                            [
+                             "ffmpeg", "-hide_banner",
+                             "-f" , _FFMPEG_SAMPLE_FORMATS[samples.itemsize],
+                             "-ar", str(rate),
+                             "-ac", str(samples.shape[1]),
+                             "-i" , "-",
+                             "-af", f"silencedetect=noise={silence_threshold}dB:d={min_silence_len / 1000}",
+                             "-f" , "null", "-",
+                            ],
+                            input=samples.tobytes(),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            check=True,
+                           )
+
+    return silencedetect_bounds(result.stderr, rate, len(samples))
+
+
+def silencedetect_bounds(stderr: bytes, rate: int, n_frames: int) -> tuple[int, int]:
+    """
+    Indices (in frames) where the leading silence ends and the trailing silence starts,
+    parsed from the 'stderr' of ffmpeg's 'silencedetect' filter run over 'n_frames' frames.
+    """
+
+    silence_segments = []
+    for kind, seconds in _SILENCEDETECT_RE.findall(stderr):
+        frame = min(max(round(float(seconds) * rate), 0), n_frames)
+        if kind == b"start":
+            silence_segments.append([frame, None])
+        elif silence_segments:
+            silence_segments[-1][1] = frame
+
+    _logger.debug(f"Segments of detected silence (in frames): {silence_segments}")
+
+    # timestamps are only printed to 6 significant digits, so are allowed to be off by up to a millisecond
+    tolerance = rate // 1000
+
+    silence_end, silence_start = 0, n_frames
+    if silence_segments:
+        first_start, first_end = silence_segments[0]
+        if first_start <= tolerance:
+            silence_end = n_frames if first_end is None else first_end
+
+        last_start, last_end = silence_segments[-1]
+        if last_end is None or last_end >= n_frames - tolerance:
+            silence_start = last_start
+
+    return silence_end, silence_start
+
+
+@njit(cache=True, fastmath=True)
+def _compress_kernel(
+                     samples        : np.ndarray,
+                     thresh_rms     : float,
+                     ratio          : float,
+                     look_frames    : int,
+                     attack_frames  : float,
+                     release_frames : float,
+                    ) -> None:
+    """
+    Per-frame state machine of 'compress_dynamic_range', applied in place.
+    The RMS over the previous 'look_frames' frames is kept as a running sum
+    of the uncompressed frame energies rather than recomputed for every frame.
+    """
+
+    n_frames, n_channels = samples.shape
+
+    energies = np.zeros(max(look_frames, 1))
+    window = 0.0
+    attenuation = 0.0
+
+    for i in range(n_frames):
+        count = min(i, look_frames) * n_channels
+        rms_now = np.sqrt(max(window, 0.0) / count) if count else 0.0
+
+        db_over_threshold = 20.0 * np.log10(rms_now / thresh_rms) if rms_now > 0.0 else 0.0
+        max_attenuation = (1.0 - 1.0 / ratio) * max(db_over_threshold, 0.0)
+
+        if rms_now > thresh_rms and attenuation <= max_attenuation:
+            attenuation = min(attenuation + max_attenuation / attack_frames, max_attenuation)
+        else:
+            attenuation = max(attenuation - max_attenuation / release_frames, 0.0)
+
+        energy = 0.0
+        for c in range(n_channels):
+            energy += samples[i, c] * samples[i, c]
+        if look_frames:
+            slot = i % look_frames
+            window += energy - energies[slot]
+            energies[slot] = energy
+
+        if attenuation != 0.0:
+            gain = 10.0 ** (-attenuation / 20.0)
+            for c in range(n_channels):
+                samples[i, c] *= gain
+
+
+def compress_dynamic_range(
+                           samples   : np.ndarray,
+                           rate      : int,
+                           threshold : float = -20.0,
+                           ratio     : float = 4.0,
+                           attack    : float = 5.0,
+                           release   : float = 50.0,
+                          ) -> None:
+    """
+    In-place equivalent of pydub's 'AudioSegment.compress_dynamic_range'
+    for the float (frames, channels) PCM 'samples', which must be C-contiguous.
+    """
+
+    _compress_kernel(
+                     samples,
+                     10 ** (threshold / 20),
+                     ratio,
+                     int(attack * rate / 1000),
+                     attack * rate / 1000,
+                     release * rate / 1000,
+                    )
+
+
+def dbfs(samples: np.ndarray) -> float:
+    """dBFS of the float PCM 'samples'."""
+    return 20 * np.log10(np.sqrt(np.mean(np.square(samples), dtype=np.float64)))
+
+
+def peak_gain(samples: np.ndarray) -> float:
+    """Gain that pydub's 'AudioSegment.normalize' would apply to the integer PCM 'samples'."""
+
+    peak = max(int(samples.max(initial=0)), -int(samples.min(initial=0)))
+    if peak == 0:
+        return 1.0
+
+    return (1 << (8 * samples.itemsize - 1)) * 10 ** (-_NORMALIZE_HEADROOM / 20) / peak
+
+
+def to_float(samples: np.ndarray, gain: float = 1.0, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Integer PCM 'samples' scaled by 'gain' into float32 full scale,
+    straight into a single array (or 'out') rather than converting then dividing into a second one.
+    """
+
+    return np.multiply(samples, gain / (1 << (8 * samples.itemsize - 1)), out=out, dtype=np.float32)
+
+
+def scratch_buffer(shape: tuple[int, ...]) -> np.ndarray:
+    """
+    Float32 array of 'shape' backed by a buffer of the calling thread, reused across songs of up to
+    '_SCRATCH_MAX_SIZE' samples instead of allocating (and page faulting in) a fresh one for each.
+    Only valid until the next call.
+    """
+
+    size = int(np.prod(shape))
+
+    # longer songs get an array of their own, so one of them cannot pin gigabytes for the life of the thread
+    if size > _SCRATCH_MAX_SIZE:
+        return np.empty(shape, dtype=np.float32)
+
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.size < size:
+        buffer = _scratch.buffer = np.empty(size, dtype=np.float32)
+
+    return buffer[ : size ].reshape(shape)
+
+
+def trim_silence(
+                 samples           : np.ndarray,
+                 rate              : int,
+                 silence_threshold : int | float,
+                 min_silence_len   : int,
+                 detector          : SilenceDetector = SilenceDetector.CHUNK,
+                 max_scan_ms       : int             = 30000,
+                ) -> np.ndarray:
+    """
+    View of the integer (frames, channels) PCM 'samples' without any leading or trailing silence
+    of at least 'min_silence_len' ms.
+    Only the first and last 'max_scan_ms' are scanned, anything past them is assumed not silent.
+    """
+
+    scan_frames = max_scan_ms * rate // 1000
+    head = samples[ : scan_frames ]
+    tail = samples[ max(len(samples) - scan_frames, 0) : ]
+    tail_offset = len(samples) - len(tail)
+
+    if detector == SilenceDetector.FFMPEG:
+        if tail_offset == 0:
+            silence_end, silence_start = ffmpeg_silence_bounds(samples, rate, silence_threshold, min_silence_len)
+        else:
+            silence_end, _   = ffmpeg_silence_bounds(head, rate, silence_threshold, min_silence_len)
+            _, silence_start = ffmpeg_silence_bounds(tail, rate, silence_threshold, min_silence_len)
+            silence_start += tail_offset
+    else:
+        silence_end   = silent_end_ind(head, rate, silence_threshold,  _CHUNK_MS)
+        silence_start = silent_end_ind(tail, rate, silence_threshold, -_CHUNK_MS) + tail_offset
+
+    _logger.debug("Leading silence ends at %d ms, trailing silence starts at %d ms",
+                  silence_end * 1000 // rate, silence_start * 1000 // rate)
+
+    min_silence_frames = min_silence_len * rate // 1000
+
+    if silence_end < silence_start:
+        if len(samples) - silence_start >= min_silence_frames:
+            samples = samples[ : silence_start ]
+        if silence_end >= min_silence_frames:
+            samples = samples[ silence_end : ]
+
+    return samples
+
+
+def normalize_loudness(samples: np.ndarray, rate: int, target: int | float) -> None:
+    """Loudness normalizes the float PCM 'samples' to 'target' LUFS in place."""
+
+    loudness = _meter(rate).integrated_loudness(samples)
+
+    if np.isfinite(loudness):
+        np.multiply(samples, 10 ** ((target - loudness) / 20), out=samples)
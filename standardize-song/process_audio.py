@@ -2,46 +2,90 @@
 
 import argparse
 import logging
+import multiprocessing
+import os
 import sys
 import io
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional, NoReturn
+from typing import Optional
 
-import pyloudnorm as pyln
+import numpy as np
 import soundfile as sf
-from pydub import AudioSegment
-from pydub.silence import detect_silence
+from numba import config, set_num_threads
+
+from audio_ops import (
+                       SilenceDetector,
+                       arg_error,
+                       compress_dynamic_range,
+                       dbfs,
+                       load_pcm,
+                       normalize_loudness,
+                       peak_gain,
+                       scratch_buffer,
+                       to_float,
+                       trim_silence,
+                      )
 
 
 _logger = logging.getLogger(__name__)
 
+_WRITE_BUFFER_SIZE = 1 << 20
 
 
-def _arg_error(message: str) -> NoReturn:
-    _logger.critical(message)
-    raise ValueError
 
-
-def process_song(
-                 input_audio        ,
-                 output_audio = None,
-                 allow_overwrite   : bool        = False,
-                 lufs_normalize    : int | float = -14.0,
-                 min_silence_len   : int         = 1000 ,
-                 silence_threshold : int | float = -30.0,
-                ) -> Optional[io.BytesIO]:
+def _check_song_args(
+                     allow_overwrite   : bool                  = False,
+                     lufs_normalize    : int | float           = -14.0,
+                     min_silence_len   : int                   = 1000 ,
+                     silence_threshold : int | float           = -30.0,
+                     silence_detector  : SilenceDetector | str = SilenceDetector.CHUNK,
+                     max_scan_ms       : int                   = 30000,
+                    ) -> SilenceDetector:
+    """Validates the song-independent arguments of 'process_song', returning 'silence_detector' as an enum."""
 
     if not isinstance(allow_overwrite, bool):
-        _arg_error("'allow_overwrite' must be a boolean")
+        arg_error("'allow_overwrite' must be a boolean")
 
     if not (isinstance(lufs_normalize, (int, float)) and lufs_normalize <= 0):
-        _arg_error("'silence_length' must be non-positive")
+        arg_error("'lufs_normalize' must be non-positive")
 
     if not (isinstance(min_silence_len, int) and min_silence_len >= 0):
-        _arg_error("'minimum_silence_length' must be non-negative")
+        arg_error("'min_silence_len' must be a non-negative integer")
 
     if not (isinstance(silence_threshold, (int, float)) and silence_threshold < 0):
-        _arg_error("'silence_length' must be negative")
+        arg_error("'silence_threshold' must be negative")
+
+    try:
+        silence_detector = SilenceDetector(silence_detector)
+    except ValueError:
+        arg_error(f"'silence_detector' must be one of {[detector.value for detector in SilenceDetector]}")
+
+    if not (isinstance(max_scan_ms, int) and max_scan_ms > 0):
+        arg_error("'max_scan_ms' must be a positive integer")
+
+    return silence_detector
+
+
+def process_song(
+                 input_audio        ,
+                 output_audio = None,
+                 allow_overwrite   : bool                  = False,
+                 lufs_normalize    : int | float           = -14.0,
+                 min_silence_len   : int                   = 1000 ,
+                 silence_threshold : int | float           = -30.0,
+                 silence_detector  : SilenceDetector | str = SilenceDetector.CHUNK,
+                 max_scan_ms       : int                   = 30000,
+                ) -> Optional[io.BytesIO]:
+
+    silence_detector = _check_song_args(
+                                        allow_overwrite,
+                                        lufs_normalize,
+                                        min_silence_len,
+                                        silence_threshold,
+                                        silence_detector,
+                                        max_scan_ms,
+                                       )
 
 
     if return_stream := output_audio is None and isinstance(input_audio, io.IOBase):
@@ -58,64 +102,120 @@ def process_song(
         if isinstance(output_audio, str):
             output_audio = Path(output_audio)
 
-        if not allow_overwrite and input_audio.resolve() == output_audio.resolve():
-            _arg_error(' '.join(("Must give permission to overwrite input file",
+        if not allow_overwrite and output_audio.exists() and os.path.samefile(input_audio, output_audio):
+            arg_error(' '.join(("Must give permission to overwrite input file",
                                   "or supply different output path.",
                                  )))
 
+        # checked up front, as the output file is already emptied by the time soundfile would notice
+        if not sf.check_format(output_audio.suffix[1:]):
+            arg_error(f"Cannot infer a writable audio format from the extension of '{output_audio}'")
+
 
 
 
-    # pydub
+    data, rate = load_pcm(input_audio)
 
-    song = AudioSegment.from_file(input_audio).normalize()
+    _logger.debug("Length of 'input_audio': %d ms", len(data) * 1000 // rate)
 
-    silence_segments = detect_silence(
-                                      song,
-                                      min_silence_len=min_silence_len,
-                                      silence_thresh=silence_threshold,
-                                     )
+    # rather than peak normalizing the PCM up front (a full extra pass and copy),
+    # its gain is folded into the silence threshold and the float conversion
+    gain = peak_gain(data)
 
-    _logger.debug("Length of 'input_audio': %d ms", len(song))
-    _logger.debug(f"Segments of detected silence: {silence_segments}")
+    data = trim_silence(
+                        data,
+                        rate,
+                        silence_threshold - 20 * np.log10(gain),
+                        min_silence_len,
+                        silence_detector,
+                        max_scan_ms,
+                       )
 
-    if silence_segments and silence_segments != [[0, len(song)]]:
-        if silence_segments[-1][1] == len(song):
-            song = song[ : silence_segments[-1][0] ]
-        if silence_segments[0][0] == 0:
-            song = song[ silence_segments[0][1] : ]
+    _logger.debug("New length of audio: %d ms", len(data) * 1000 // rate)
 
-    _logger.debug("New length of audio: %d ms", len(song))
+    data = to_float(data, gain, out=scratch_buffer(data.shape))
 
     # compress
 
-    _logger.debug("dBFS of audio currently: %.6f", song.dBFS)
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug("dBFS of audio currently: %.6f", dbfs(data))
 
-    song = song.compress_dynamic_range()
+    compress_dynamic_range(data, rate)
 
-    _logger.debug("dBFS of compressed audio: %.6f", song.dBFS)
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug("dBFS of compressed audio: %.6f", dbfs(data))
 
-    intermediate_stream = io.BytesIO()
+    # normalize
 
-    song.export(intermediate_stream, format="wav")
+    normalize_loudness(data, rate, lufs_normalize)
 
+    if isinstance(output_audio, Path):
+        # soundfile otherwise writes a path in many small chunks
+        with open(output_audio, "wb", buffering=_WRITE_BUFFER_SIZE) as output_file:
+            sf.write(output_file, data, rate)
+    else:
+        sf.write(output_audio, data, rate)
 
-    # normalize
-    data, rate = sf.read(intermediate_stream)
+    if return_stream:
+        return output_audio
 
 
+def process_songs(
+                  input_dir          ,
+                  output_dir  = None ,
+                  pattern     : str           = "*.wav",
+                  max_workers : Optional[int] = None,
+                  **kwargs,
+                 ) -> list[Path]:
+    """
+    'process_song' on every file in 'input_dir' matching 'pattern', into the same name in 'output_dir',
+    spread over 'max_workers' processes so that imports, JIT compilation and meters are reused across songs.
+    Returns the files that could not be processed.
+    """
 
-    # measure the loudness first 
-    meter = pyln.Meter(rate) # create BS.1770 meter
-    loudness = meter.integrated_loudness(data)
+    # checked once here rather than failing every song in the workers
+    _check_song_args(**kwargs)
 
-    # loudness normalize audio to -12 dB LUFS
-    loudness_normalized_audio = pyln.normalize.loudness(data, loudness, lufs_normalize)
+    if not (max_workers is None or isinstance(max_workers, int) and max_workers > 0):
+        arg_error("'max_workers' must be a positive integer")
 
-    sf.write(output_audio, loudness_normalized_audio, rate)
+    input_dir  = Path(input_dir)
+    output_dir = input_dir if output_dir is None else Path(output_dir)
 
-    if return_stream:
-        return output_audio
+    if (not kwargs.get("allow_overwrite", False)
+        and output_dir.exists() and os.path.samefile(input_dir, output_dir)):
+        arg_error(' '.join(("Must give permission to overwrite input files",
+                              "or supply different output directory.",
+                             )))
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    failed = []
+
+    # the cores are split between the workers rather than every worker's Numba kernels using all of them
+    max_workers = max_workers or os.cpu_count() or 1
+    numba_threads = max(config.NUMBA_NUM_THREADS // max_workers, 1)
+
+    # spawned rather than forked, as forking once Numba's threading layer is running can hang at exit
+    with ProcessPoolExecutor(
+                             max_workers=max_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=set_num_threads,
+                             initargs=(numba_threads,),
+                            ) as executor:
+        futures = {
+                   executor.submit(process_song, path, output_dir / path.name, **kwargs): path
+                   for path in sorted(input_dir.glob(pattern)) if path.is_file()
+                  }
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                _logger.exception("Failed to process '%s'", futures[future])
+                failed.append(futures[future])
+
+    return failed
 
 
 
@@ -127,7 +227,7 @@ def process_song(
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-                                     description="Normalizes, trims silence and compresses an audio file.",
+                                     description="Normalizes, trims silence and compresses an audio file or directory of them.",
                                     )
 
     parser.add_argument("input_audio" , type=Path)
@@ -147,6 +247,24 @@ if __name__ == "__main__":
     meta_group.add_argument("--debug", action="store_true")
 
 
+    batch_group = parser.add_argument_group(
+                                            "batch arguments",
+                                            "Used when 'input_audio' is a directory, "
+                                            "in which case 'output_audio' is one as well.",
+                                           )
+
+    batch_group.add_argument(
+                             "--glob",
+                             default="*.wav",
+                             help="Pattern of the files in 'input_audio' to process.",
+                            )
+    batch_group.add_argument(
+                             "--jobs",
+                             type=int,
+                             help="Number of songs to process in parallel. Must be > 0. Defaults to the number of CPUs.",
+                            )
+
+
     var_group = parser.add_argument_group("variable arguments")
 
     var_group.add_argument(
@@ -160,7 +278,7 @@ if __name__ == "__main__":
                            default=argparse.SUPPRESS,
                            type=int,
                            help=' '.join(("Minimum length of silence segment to consider",
-                                          "in milliseconds. Must be integer > 0.",
+                                          "in milliseconds. Must be integer >= 0.",
                                           )),
                           )
     var_group.add_argument(
@@ -169,6 +287,22 @@ if __name__ == "__main__":
                            type=float,
                            help="Volume threshold to consider silence in dBFS. Must be < 0.",
                           )
+    var_group.add_argument(
+                           "--silence-detector",
+                           default=argparse.SUPPRESS,
+                           choices=[detector.value for detector in SilenceDetector],
+                           help=' '.join(("Whether to detect silence with NumPy over fixed-size chunks",
+                                          "or with ffmpeg's 'silencedetect' filter.",
+                                          )),
+                          )
+    var_group.add_argument(
+                           "--max-scan-ms",
+                           default=argparse.SUPPRESS,
+                           type=int,
+                           help=' '.join(("How far into each end of the audio to look for silence",
+                                          "in milliseconds. Must be integer > 0.",
+                                          )),
+                          )
 
 
 
@@ -176,8 +310,17 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG if args.pop("debug") else logging.WARNING)
 
+    # numba otherwise floods the debug output with its compiler passes
+    logging.getLogger("numba").setLevel(logging.WARNING)
+
+
+    pattern, jobs = args.pop("glob"), args.pop("jobs")
 
     try:
-        assert process_song(**args) is None
+        if args["input_audio"].is_dir():
+            if process_songs(args.pop("input_audio"), args.pop("output_audio"), pattern, jobs, **args):
+                parser.exit(1)
+        else:
+            assert process_song(**args) is None
     except ValueError as e:
         parser.exit(2)
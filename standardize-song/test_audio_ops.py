@@ -0,0 +1,47 @@
+from audio_ops import silencedetect_bounds
+
+
+RATE = 44100
+
+# stderr of 'ffmpeg -af silencedetect ... -f null -', in the '%.6g' format of ffmpeg releases before 7
+SONG_STDERR = b"""\
+Input #0, s16le, from 'fd:':
+  Duration: N/A, bitrate: 1411 kb/s
+  Stream #0:0: Audio: pcm_s16le, 44100 Hz, 2 channels, s16, 1411 kb/s
+[silencedetect @ 0x55d5c6a0c8c0] silence_start: 0
+[silencedetect @ 0x55d5c6a0c8c0] silence_end: 1.50499 | silence_duration: 1.50499
+[silencedetect @ 0x55d5c6a0c8c0] silence_start: 183.712
+[silencedetect @ 0x55d5c6a0c8c0] silence_end: 185.712 | silence_duration: 2.00002
+size=N/A time=00:03:05.71 bitrate=N/A speed= 512x
+"""
+
+
+def test_trailing_silence_with_rounded_end():
+    # 185.712018 s, which ffmpeg prints as 185.712
+    assert silencedetect_bounds(SONG_STDERR, RATE, 8189900) == (66370, 8101699)
+
+
+def test_exponent_notation():
+    stderr = b"""\
+[silencedetect @ 0x55d5c6a0c8c0] silence_start: 0
+[silencedetect @ 0x55d5c6a0c8c0] silence_end: 2.26757e-05 | silence_duration: 2.26757e-05
+"""
+    assert silencedetect_bounds(stderr, RATE, RATE) == (1, RATE)
+
+
+def test_silence_open_at_eof():
+    stderr = b"[silencedetect @ 0x55d5c6a0c8c0] silence_start: 12.5\n"
+    assert silencedetect_bounds(stderr, RATE, 20 * RATE) == (0, 551250)
+
+
+def test_all_silent():
+    stderr = b"[silencedetect @ 0x55d5c6a0c8c0] silence_start: 0\n"
+    assert silencedetect_bounds(stderr, RATE, 20 * RATE) == (20 * RATE, 0)
+
+
+def test_no_trailing_silence():
+    stderr = b"""\
+[silencedetect @ 0x55d5c6a0c8c0] silence_start: 5
+[silencedetect @ 0x55d5c6a0c8c0] silence_end: 6 | silence_duration: 1
+"""
+    assert silencedetect_bounds(stderr, RATE, 20 * RATE) == (0, 20 * RATE)